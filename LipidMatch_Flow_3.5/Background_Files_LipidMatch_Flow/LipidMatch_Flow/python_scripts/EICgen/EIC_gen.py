@@ -8,29 +8,31 @@
 
 # imports
 import argparse
-import asyncio
-import csv
+import json
 import os
 import numpy as np
 import pandas
+import sys
 import time
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date
-from dataclasses import dataclass
-from mzXML_to_csv import parse_mzXML
+from numba import njit, prange, types
+from pyarrow import csv as pacsv
+from mzXML_to_csv import arrays_to_csv, parse_mzXML_to_arrays
 
 """
-Convert mzXML files in the target directory to CSV format, 
-and then generate EIC csv files for each feature of the target 
-file, filtered to an m/z tolerance.
+Parse mzXML files in the target directory, and then generate
+EIC csv files for each feature of the target file, filtered
+to an m/z tolerance. mzXML files are parsed in memory, unless
+they were already converted to CSV format on an earlier run
+(see --cache_csv).
 
 example command:
     python3 EIC_gen.py --mz_column 6 --rt_column 7 --mz_tolerance 0.005 --feature_id_col 12 --target_file NegIDed_FIN.csv
     --target_dir ../NTA-Tools/Test_Files
 
 Alternatively, the EICgen class can be imported into another python file and run from there:
-    import asyncio
     from EIC_gen import EICgen
     eic = EICgen(**dict(
         mz_column=6,
@@ -41,13 +43,14 @@ Alternatively, the EICgen class can be imported into another python file and run
         target_file='NegIDed_FIN.csv',
         target_dir='../NTA-Tools/Test_Files')
     )
-    asyncio.run(eic.run())
+    eic.run()
 
 
-NOTE: the outfile size will be in the GB domain
+NOTE: the outfile size will be in the GB domain, as will the array cache
+that is saved to the target directory (see --no_array_cache)
 """
 
-parser = argparse.ArgumentParser(description='Convert mzXML files in the target directory to CSV format, '
+parser = argparse.ArgumentParser(description='Parse mzXML files in the target directory, '
                                              'and then generate EIC csv files for each feature of the target '
                                              'file, filtered to an m/z tolerance.')
 parser.add_argument('--mz_column',
@@ -87,13 +90,131 @@ parser.add_argument('--target_dir',
                     help='Path of the target directory, where the mxXML files and the target csv file are located. It '
                          'is also the output location of the EIC csv file that will be generated',
                     default='../NTA-Tools/Test_Files')
-
-
-@dataclass
-class Feature:
-    mz: float
-    RT: float
-    feature_id: str
+parser.add_argument('--cache_csv',
+                    dest='cache_csv',
+                    action='store_true',
+                    help='Also write each parsed mzXML file to a csv file next to it, '
+                         'which is read instead of the mzXML file on later runs')
+parser.add_argument('--no_array_cache',
+                    dest='array_cache',
+                    action='store_false',
+                    help='Do not save the parsed mzXML data as memory mapped arrays in the target directory '
+                         '(by default they are saved, and reused on later runs over the same mzXML files)')
+
+
+# columns of the EIC csv file
+EIC_COLUMNS = ['Feature', 'RT', 'Intensity', 'mz', 'File', 'Zoom']
+
+# directory (within the target directory) of the memory mapped array cache,
+# and the arrays it holds
+ARRAY_CACHE_DIR = 'EIC_array_cache'
+ARRAY_CACHE_COLUMNS = ['mz', 'rt', 'intensity', 'file_idx']
+
+# format version of the array cache, recorded in its manifest. Bump it
+# whenever the meaning or dtype of a cached column changes, so that caches
+# written by older versions are rebuilt rather than reused
+# (2: intensity is stored as float32)
+ARRAY_CACHE_VERSION = 2
+
+
+# numba can't cache compiled kernels in a pyinstaller bundled executable,
+# as the module source isn't on disk there
+CACHE_KERNELS = not getattr(sys, 'frozen', False)
+
+# argument types of the compiled kernels, which are compiled with explicit
+# signatures when this module is imported rather than on their first call.
+# The sorted mzXML columns are always read-only (see EICgen.__init__)
+_f8_column = types.Array(types.float64, 1, 'C', readonly=True)
+_f4_column = types.Array(types.float32, 1, 'C', readonly=True)
+_i4_column = types.Array(types.int32, 1, 'C', readonly=True)
+
+
+@njit(types.int64(_f8_column, types.int64, types.float64, types.boolean), cache=CACHE_KERNELS)
+def _gallop(mz, start, value, right):
+    """
+    Returns the first index from start on where the sorted mz column is above
+    value (right), or at least value (not right). The search steps outwards
+    from start in doubling strides, so its cost grows with the distance moved
+    rather than with the length of the column
+    """
+    n = mz.shape[0]
+    step = 1
+    end = start
+    while end < n and (mz[end] <= value if right else mz[end] < value):
+        start = end + 1
+        end = start + step
+        step *= 2
+    end = min(end, n)
+    if right:
+        return start + np.searchsorted(mz[start:end], value, side='right')
+    return start + np.searchsorted(mz[start:end], value, side='left')
+
+
+@njit(types.Tuple((types.int64[::1], types.int64[::1]))(_f8_column, types.float64[::1], types.float64),
+      cache=CACHE_KERNELS)
+def sweep_windows(mz, feat_mz, tolerance):
+    """
+    Takes the sorted mz column and an ascending array of feature mz values,
+    and returns the start index and row count of each feature's (open)
+    tolerance window. Both window bounds only move forward from one feature
+    to the next, so they are found by two cursors sweeping the mz column once
+    """
+    n_features = feat_mz.shape[0]
+    lo = np.empty(n_features, dtype=np.int64)
+    counts = np.empty(n_features, dtype=np.int64)
+    lo_cursor = 0
+    hi_cursor = 0
+    for i in range(n_features):
+        # a NaN mz matches no rows (argsort places NaN values last, and
+        # the cursors cannot move on NaN comparisons, so they would
+        # otherwise keep the previous feature's window)
+        if feat_mz[i] != feat_mz[i]:
+            lo[i] = lo_cursor
+            counts[i] = 0
+            continue
+        lo_cursor = _gallop(mz, lo_cursor, feat_mz[i] - tolerance, True)
+        hi_cursor = _gallop(mz, hi_cursor, feat_mz[i] + tolerance, False)
+        lo[i] = lo_cursor
+        counts[i] = max(hi_cursor - lo_cursor, 0)
+    return lo, counts
+
+
+@njit(types.Tuple((types.float64[:, ::1], types.float32[::1], types.uint8[::1]))(
+          _f8_column, _f8_column, _f4_column, _i4_column,
+          types.int64[::1], types.int64[::1], types.float64[::1], types.float64),
+      parallel=True, cache=CACHE_KERNELS)
+def build_rows(mz, rt, intensity, file_idx, lo, counts, feat_rt, zoom_window):
+    """
+    Takes the mz-sorted columns, and the mz window (see EICgen.feature_windows)
+    and RT value of a batch of features, and returns a float array of feature
+    rows with the columns: (feature index, rt, mz, file index), along with
+    float32 and uint8 arrays of the rows' intensities and zoom flags
+    """
+    n_features = lo.shape[0]
+
+    offsets = np.zeros(n_features + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    out = np.empty((offsets[n_features], 4), dtype=np.float64)
+    out_intensity = np.empty(offsets[n_features], dtype=np.float32)
+    zoom = np.empty(offsets[n_features], dtype=np.uint8)
+    for i in prange(n_features):
+        # the zoom window bounds are computed once per feature, and the
+        # window test is fused into the copy loop, so each rt value is
+        # read once and no intermediate boolean arrays are built
+        rt_lo = feat_rt[i] - zoom_window
+        rt_hi = feat_rt[i] + zoom_window
+        for k in range(counts[i]):
+            j = lo[i] + k
+            r = offsets[i] + k
+            row_rt = rt[j]
+            out[r, 0] = i
+            out[r, 1] = row_rt
+            out[r, 2] = mz[j]
+            out[r, 3] = file_idx[j]
+            out_intensity[r] = intensity[j]
+            zoom[r] = (row_rt > rt_lo) & (row_rt < rt_hi)
+    return out, out_intensity, zoom
 
 
 class EICgen:
@@ -103,10 +224,12 @@ class EICgen:
     """
 
     def __init__(self, *args, **kwargs):
-        # silence complaints about valid chained assignment use
-        pandas.options.mode.chained_assignment = None
-
-        self.max_threads = os.cpu_count() + 1
+        # reading and parsing the mzXML files is I/O bound, so its thread
+        # pool is sized above the core count (as is the standard library
+        # default). Feature rows are built by the numba kernels, which run
+        # on numba's own threads
+        self.max_threads = min(32, (os.cpu_count() or 1) + 4)
+        self.feature_batch_size = 1000
         self.mzXML_dir = kwargs['target_dir']
         self.target_file = kwargs['target_file']
         print(f"Running EIC csv generation against target file: {self.target_file}, target dir: {self.mzXML_dir}")
@@ -115,35 +238,54 @@ class EICgen:
         self.mz_col = kwargs['mz_column'] - 1
         self.RT_col = kwargs['rt_column'] - 1
         self.feature_id_col = kwargs['feature_id_col'] - 1
-        self.tolerance = kwargs['mz_tolerance']
-        self.zoom_window = kwargs['zoom_window']
-
-        # compile a list of all mxXML files in the target directory
-        self.dir_files = [os.path.abspath(os.path.join(self.mzXML_dir, f)) for f in os.listdir(self.mzXML_dir)]
-        self.mzXML_files = [f for f in self.dir_files if f.split('.')[-1] == 'mzXML']
-
-        # convert mxXML files to csv to get started
-        self.mzCSV_files = self.convert_all_mzXML_to_CSV()
-
-        # read all csv files into memory before parsing
+        self.tolerance = float(kwargs['mz_tolerance'])
+        self.zoom_window = float(kwargs['zoom_window'])
+        self.cache_csv = kwargs.get('cache_csv', False)
+        self.array_cache = kwargs.get('array_cache', True)
+
+        # compile a list of all mxXML files in the target directory,
+        # and the set of csv files already converted from them, in one pass
+        with os.scandir(self.mzXML_dir) as entries:
+            dir_files = [entry.path for entry in entries if entry.is_file()]
+        self.mzXML_files = sorted(f for f in dir_files if f.endswith('.mzXML'))
+        self.existing_csvs = {f for f in dir_files if f.endswith('.csv')}
+
+        # the csv file of each mzXML file, which is read instead of
+        # the mzXML file when it was already converted
+        self.mzCSV_files = [os.path.splitext(f)[0] + '.csv' for f in self.mzXML_files]
+
+        # parse all mzXML files into memory before parsing features
         # (this is the current approach, other approaches
-        # may be explored in the future)
-        self.dfs = self.read_mzCSV_files()
-
-    async def run(self):
+        # may be explored in the future). The rows are kept as
+        # parallel mz-sorted column arrays, so that feature lookups
+        # can binary search the mz column. File names are stored as
+        # integer indexes into self._file_names, as strings cannot be
+        # passed to the compiled build_rows kernel. The columns are
+        # memory mapped from the array cache where possible, so that
+        # only the pages of the feature windows are read into memory
+        self._mz, self._rt, self._intensity, self._file_idx = self.load_sorted_columns()
+        for column in (self._mz, self._rt, self._intensity, self._file_idx):
+            column.flags.writeable = False
+        self._file_names = np.array([os.path.basename(f) for f in self.mzCSV_files], dtype=object)
+
+        # the target file features, as parallel mz, RT and feature id arrays
+        self._feat_mz, self._feat_rt, self._feat_id = self.features()
+        self._feat_lo, self._feat_count = self.feature_windows(self._feat_mz)
+
+    def run(self):
         t0 = time.monotonic()
         out = os.path.join(self.mzXML_dir, date.today().strftime('%Y_%m_%d') + '_EIC_CSV.csv')
-        with open(out, 'w') as EICfile:
-            writer = csv.writer(EICfile)
-            writer.writerow(['Feature', 'RT', 'Intensity', 'mz', 'File', 'Zoom'])
-
-            async def write_feature_rows(f):
-                rows = await self.get_feature_rows(f)
-                writer.writerows(rows)
-
-            await asyncio.wait(
-                [write_feature_rows(f) for f in self.features()]
-            )
+        with open(out, 'w', newline='') as EICfile:
+            pandas.DataFrame(columns=EIC_COLUMNS).to_csv(EICfile, index=False)
+
+            # feature lookups are CPU bound, so features are handed to the
+            # compiled build_rows kernel, which runs in parallel over each batch,
+            # and each batch of rows is written out by the pandas C csv writer
+            for i in range(0, len(self._feat_mz), self.feature_batch_size):
+                batch = slice(i, i + self.feature_batch_size)
+                self.get_batch_rows(
+                    self._feat_lo[batch], self._feat_count[batch], self._feat_rt[batch], self._feat_id[batch]
+                ).to_csv(EICfile, header=False, index=False)
 
         tf = time.monotonic()
         print("time: ", tf - t0)
@@ -151,73 +293,193 @@ class EICgen:
 
     @staticmethod
     def read_csv(csv_file):
-        df = pandas.read_csv(csv_file)
-        df['File'] = os.path.basename(csv_file)
-        return df
+        """
+        Returns the mz, rt (float64) and intensity (float32) columns of a csv file.
+        The file is parsed by pyarrow, which releases the GIL while parsing,
+        so files read concurrently on the thread pool are parsed in parallel.
+        pyarrow parses floats exactly, so a csv written by mzXML_to_csv or
+        arrays_to_csv gives the same values as parsing its mzXML file in
+        memory (see load_mzXML)
+        """
+        columns = ['mz', 'rt', 'intensity']
+        table = pacsv.read_csv(csv_file, convert_options=pacsv.ConvertOptions(
+            include_columns=columns,
+            column_types={'mz': 'float64', 'rt': 'float64', 'intensity': 'float32'}
+        ))
+        return tuple(table.column(c).to_numpy() for c in columns)
 
     @staticmethod
     def chunk(rows, chunk_size):
         for i in range(0, len(rows), chunk_size):
             yield rows[i:i + chunk_size]
 
-    def convert_all_mzXML_to_CSV(self):
+    def load_mzXML(self, mzXML_file, mzCSV_file, file_id):
         """
-        Parse all mzXML files in the target directory to csv (does not recursively walk the dir),
-        and return a list of the converted csv files
+        Returns the mz, rt (float64) and intensity (float32) columns of a mzXML file,
+        read from its csv file if it was already converted, and otherwise parsed
+        in memory (and written to the csv file if cache_csv is set). A fourth,
+        int32 column holds file_id, the file's index into self._file_names
         """
-        mzCSV_files = []
-        with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-            for mzXML_file in self.mzXML_files:
-                out = mzXML_file.split('.')[0] + '.csv'
-                mzCSV_files.append(out)
-                if out in self.dir_files:
-                    continue
-                executor.submit(parse_mzXML, mzXML_file)
-        return mzCSV_files
-
-    def read_mzCSV_files(self):
+        if mzCSV_file in self.existing_csvs:
+            mz, rt, intensity = self.read_csv(mzCSV_file)
+        else:
+            mz, rt, intensity = parse_mzXML_to_arrays(mzXML_file)
+            if self.cache_csv:
+                arrays_to_csv(mz, rt, intensity, mzCSV_file)
+        # intensities stay float32 (as pyopenms stores them), so they are
+        # written in their shortest float32 form (95312.86 and not the
+        # widened 95312.859375) whichever way the file was loaded
+        return (mz.astype(np.float64, copy=False),
+                rt.astype(np.float64, copy=False),
+                intensity.astype(np.float32, copy=False),
+                np.full(len(mz), file_id, dtype=np.int32))
+
+    def parse_all_mzXML(self):
         """
-        Returns a list of tuples: csv filenames, paired with the dataframe objects
+        Parse all mzXML files in the target directory (does not recursively walk the dir),
+        and return their mz, rt, intensity and file index columns as parallel arrays,
+        sorted by mz. The file index is the position of the row's file in self.mzXML_files
         """
+        columns = [None] * len(self.mzXML_files)
         with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-            mz_csv_dfs = executor.map(self.read_csv, self.mzCSV_files)
-        dfs = pandas.concat(mz_csv_dfs)
-        return dfs
+            futures = {
+                executor.submit(self.load_mzXML, mzXML_file, mzCSV_file, i): i
+                for i, (mzXML_file, mzCSV_file) in enumerate(zip(self.mzXML_files, self.mzCSV_files))
+            }
+
+            # collect files as they finish, so that progress is reported and a
+            # failed file stops the run as soon as it fails, naming the file
+            for n, future in enumerate(as_completed(futures), 1):
+                i = futures[future]
+                try:
+                    columns[i] = future.result()
+                except Exception:
+                    print(f"Failed to parse mzXML file: {self.mzXML_files[i]}")
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+                print(f"Parsed {os.path.basename(self.mzXML_files[i])} ({n}/{len(futures)})")
+
+        mz = np.concatenate([c[0] for c in columns] or [np.empty(0)])
+        rt = np.concatenate([c[1] for c in columns] or [np.empty(0)])
+        intensity = np.concatenate([c[2] for c in columns] or [np.empty(0, dtype=np.float32)])
+        file_idx = np.concatenate([c[3] for c in columns] or [np.empty(0, dtype=np.int32)])
+
+        order = np.argsort(mz, kind='stable')
+        return mz[order], rt[order], intensity[order], file_idx[order]
+
+    def load_sorted_columns(self):
+        """
+        Returns the mz-sorted columns of all mzXML files (see parse_all_mzXML),
+        memory mapped from the array cache in the target directory. The cache is
+        rebuilt when it was made from different source files or by a different
+        cache version, and is skipped entirely when array_cache is not set
+        """
+        if not self.array_cache:
+            return self.parse_all_mzXML()
+
+        cache_dir = os.path.join(self.mzXML_dir, ARRAY_CACHE_DIR)
+        manifest_file = os.path.join(cache_dir, 'manifest.json')
+        cache_files = [os.path.join(cache_dir, c + '.npy') for c in ARRAY_CACHE_COLUMNS]
+
+        # the cache is identified by its format version, and by the name, size
+        # and modification time of each file it was built from: the mzXML file,
+        # and its csv file when that is read instead (see load_mzXML)
+        sources = []
+        for mzXML_file, mzCSV_file in zip(self.mzXML_files, self.mzCSV_files):
+            source_files = [mzXML_file]
+            if mzCSV_file in self.existing_csvs:
+                source_files.append(mzCSV_file)
+            for source_file in source_files:
+                stat = os.stat(source_file)
+                sources.append([os.path.basename(source_file), stat.st_size, stat.st_mtime_ns])
+        manifest = {'version': ARRAY_CACHE_VERSION, 'sources': sources}
+        try:
+            with open(manifest_file, 'r') as f:
+                cached = json.load(f) == manifest
+        except (OSError, ValueError):
+            cached = False
+
+        if cached:
+            print(f"Loading parsed mzXML data from array cache: {cache_dir}")
+        else:
+            columns = self.parse_all_mzXML()
+            if not len(columns[0]):
+                return columns
+
+            # the manifest is removed before, and written after, the arrays,
+            # so that an interrupted write never leaves a valid looking cache
+            os.makedirs(cache_dir, exist_ok=True)
+            if os.path.exists(manifest_file):
+                os.remove(manifest_file)
+            for cache_file, column in zip(cache_files, columns):
+                np.save(cache_file, column)
+            with open(manifest_file, 'w') as f:
+                json.dump(manifest, f)
+
+        return tuple(np.load(cache_file, mmap_mode='r') for cache_file in cache_files)
 
     def features(self):
-        with open(os.path.join(self.mzXML_dir, self.target_file), 'r') as NegIDfile:
-            reader = csv.reader(NegIDfile, delimiter=',')
-            next(reader)
-            for row in reader:
-                mz = float(row[self.mz_col])
-                RT = float(row[self.RT_col])
-                feature_id = row[self.feature_id_col]
-                yield Feature(mz, RT, feature_id)
-
-    async def get_feature_rows(self, F: Feature):
-        """
-        Takes a Feature object and returns a list of features rows:
+        """
+        Reads the mz, RT and feature id columns of the target file,
+        and returns them as arrays
+        """
+        path = os.path.join(self.mzXML_dir, self.target_file)
+        columns = pandas.read_csv(path, nrows=0).columns
+        mz_col, RT_col, feature_id_col = (columns[c] for c in (self.mz_col, self.RT_col, self.feature_id_col))
+        df = pandas.read_csv(path, usecols=[mz_col, RT_col, feature_id_col],
+                             dtype={feature_id_col: str}, keep_default_na=False)
+        return (df[mz_col].to_numpy(np.float64, copy=True),
+                df[RT_col].to_numpy(np.float64, copy=True),
+                df[feature_id_col].to_numpy(object))
+
+    def get_feature_rows(self, i):
+        """
+        Takes the index of a target file feature and returns a list of features rows:
         rows parsed from the mzXML files and filtered to the feature
         parameters
         """
-        df = self.dfs[(self.dfs.mz < F.mz + self.tolerance) & (self.dfs.mz > F.mz - self.tolerance)]
-        if not len(df):
-            return []
+        feature = slice(i, i + 1)
+        df = self.get_batch_rows(self._feat_lo[feature], self._feat_count[feature],
+                                 self._feat_rt[feature], self._feat_id[feature])
+        return list(df.itertuples(index=False, name=None))
 
-        df['Feature'] = F.feature_id
-        rt = df['rt']
-        df.loc[
-            np.logical_and(
-                rt.lt(F.RT + self.zoom_window),
-                rt.gt(F.RT - self.zoom_window)
-            ), 'Zoom'
-        ] = 'TRUE'
-        df['Zoom'].fillna('FALSE', inplace=True)
+    def feature_windows(self, feat_mz):
+        """
+        Takes an array of feature mz values and returns the start index and row
+        count of each feature's (open) tolerance window in the sorted mz column.
+        The windows are found in a single sweep over the features in mz order
+        (features sharing an mz share a cursor position), and are returned in
+        the original feature order
+        """
+        order = np.argsort(feat_mz, kind='stable')
+        lo = np.empty(len(feat_mz), dtype=np.int64)
+        counts = np.empty(len(feat_mz), dtype=np.int64)
+        lo[order], counts[order] = sweep_windows(self._mz, feat_mz[order], self.tolerance)
+        return lo, counts
 
-        return df[['Feature', 'rt', 'intensity', 'mz', 'File', 'Zoom']].values
+    def get_batch_rows(self, feat_lo, feat_count, feat_rt, feat_id):
+        """
+        Takes parallel arrays of feature mz windows, RT and id values and
+        returns a dataframe of the feature rows of all of them, grouped by feature
+        """
+        out, intensity, zoom = build_rows(self._mz, self._rt, self._intensity, self._file_idx,
+                               feat_lo, feat_count, feat_rt, self.zoom_window)
+
+        # feature ids and file names are kept out of the kernel, and are
+        # looked up from the index columns it returns. The zoom flags are
+        # only turned into strings here, once per batch
+        return pandas.DataFrame({
+            'Feature': feat_id[out[:, 0].astype(np.intp)],
+            'RT': out[:, 1],
+            'Intensity': intensity,
+            'mz': out[:, 2],
+            'File': np.take(self._file_names, out[:, 3].astype(np.intp)),
+            'Zoom': np.where(zoom.view(np.bool_), 'TRUE', 'FALSE')
+        }, columns=EIC_COLUMNS)
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
     e = EICgen(**vars(args))
-    asyncio.run(e.run())
+    e.run()
@@ -19,6 +19,7 @@
 
 
 ##### Import Dependencies
+import numpy as np
 import pyopenms as pyms
 import sys
 import csv
@@ -35,6 +36,55 @@ def parse_mzXML(file_path):
     pyms.MzXMLFile().load(file_path, exp)
     mzXML_to_csv(exp, file_path)
 
+def parse_mzXML_to_arrays(file_path):
+    """
+    Takes in the file path of a mzXML file, reads it and returns its
+    long-form data in memory, without writing a .csv
+
+    :param file_path: str
+    :return: tuple of numpy.ndarray (mz, rt, intensity)
+    """
+    exp = pyms.MSExperiment()
+    pyms.MzXMLFile().load(file_path, exp)
+    return mzXML_to_arrays(exp)
+
+def mzXML_to_arrays(mzXML):
+    """
+    Reads each spectrum of a MSExperiment object, which corresponds to all
+    mz, intensity pairs at a single retention time. Spectrum data are
+    returned as long-form mz, rt and intensity arrays.
+
+    :param mzXML:pyopenms.MSExperiment object
+    :return: tuple of numpy.ndarray (mz, rt, intensity)
+    """
+    mzs, rts, intensities = [], [], []
+    for spec in mzXML:
+        mz, intensity = spec.get_peaks()
+        mzs.append(mz)
+        rts.append(np.full(len(intensity), spec.getRT()))
+        intensities.append(intensity)
+    if not mzs:
+        return np.empty(0), np.empty(0), np.empty(0, dtype=np.float32)
+    # each column keeps the dtype of the spectrum data (float32 for
+    # intensity), so it is formatted the same as by mzXML_to_csv
+    return np.concatenate(mzs), np.concatenate(rts), np.concatenate(intensities)
+
+def arrays_to_csv(mz, rt, intensity, file_path):
+    """
+    Stores long-form mz, rt and intensity arrays to a local .csv, in the
+    same format as mzXML_to_csv
+
+    :param mz: numpy.ndarray
+    :param rt: numpy.ndarray
+    :param intensity: numpy.ndarray
+    :param file_path: str
+    :return: None
+    """
+    with open(file_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rt', 'mz', 'intensity'])
+        writer.writerows(zip(rt, mz, intensity))
+
 def mzXML_to_csv(mzXML, file_path):
     """
     Reads each spectrum of a MSExperiment object, which corresponds to all